@@ -5,10 +5,59 @@ import numpy as np
 import pandas as pd
 from collections import defaultdict
 
+# PPV of pDockQ at the given thresholds (thresholds in decreasing order)
+PPV = np.array([
+    0.98128027, 0.96322524, 0.95333044, 0.9400192,
+    0.93172991, 0.92420274, 0.91629946, 0.90952562, 0.90043139,
+    0.8919553, 0.88570037, 0.87822061, 0.87116417, 0.86040801,
+    0.85453785, 0.84294946, 0.83367787, 0.82238224, 0.81190228,
+    0.80223507, 0.78549007, 0.77766077, 0.75941223, 0.74006263,
+    0.73044282, 0.71391784, 0.70615739, 0.68635536, 0.66728511,
+    0.63555449, 0.55890174
+])
+PDOCKQ_THRESHOLDS = np.array([
+    0.67333079, 0.65666073, 0.63254566, 0.62604391,
+    0.60150931, 0.58313803, 0.5647381, 0.54122438, 0.52314392,
+    0.49659878, 0.4774676, 0.44661346, 0.42628389, 0.39990988,
+    0.38479715, 0.3649393, 0.34526004, 0.3262589, 0.31475668,
+    0.29750023, 0.26673725, 0.24561247, 0.21882689, 0.19651314,
+    0.17606258, 0.15398168, 0.13927677, 0.12024131, 0.09996019,
+    0.06968505, 0.02946438
+])
+
+# Defaults for batch mode
+DEFAULT_CUTOFFS = (4, 6, 8, 10, 12)  # Distance cutoffs in Å for contact counts
+DEFAULT_BATCH_SIZE = 64  # Maximum number of models per batch
+DEFAULT_MAX_PAIRS = 20000000  # Maximum number of padded residue pairs per batch
+
+def positive_int(value):
+    """argparse type for integers >= 1."""
+    try:
+        ivalue = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{value} is not an integer')
+    if ivalue < 1:
+        raise argparse.ArgumentTypeError(f'{value} must be >= 1')
+    return ivalue
+
+
 parser = argparse.ArgumentParser(description='Calculate a predicted DockQ score for a predicted structure.')
-parser.add_argument('--pdbfile', nargs=1, type=str, default=sys.stdin,
-                    help='Path to AlphaFold3 .cif file to be scored. Must contain at least two chains. '
-                         'The B-factor column is assumed to contain the plDDT score.')
+parser.add_argument('--pdbfile', nargs='+', type=str, required=True,
+                    help='Path to AlphaFold3 .cif file to be scored. Must contain exactly two chains. '
+                         'The B-factor column is assumed to contain the plDDT score. '
+                         'Several files can be given in batch mode (--tsv or --outfile).')
+parser.add_argument('--tsv', action='store_true',
+                    help='Batch mode: write interface features of all files as a .tsv table ranked by pDockQ.')
+parser.add_argument('--outfile', nargs=1, type=str, default=None,
+                    help='Path to .tsv file for batch interface features. Implies --tsv (default: print to stdout).')
+parser.add_argument('--cutoffs', nargs='+', type=float, default=None,
+                    help='Batch mode only. Distance cutoffs in Å at which interface contacts are counted '
+                         f'(default: {" ".join(map(str, DEFAULT_CUTOFFS))}).')
+parser.add_argument('--batch_size', nargs=1, type=positive_int, default=None,
+                    help=f'Batch mode only. Maximum number of models per batch (default: {DEFAULT_BATCH_SIZE}).')
+parser.add_argument('--max_pairs', nargs=1, type=positive_int, default=None,
+                    help='Batch mode only. Maximum number of padded residue pairs (n_models * l1 * l2) per batch. '
+                         f'Peak memory is roughly 9 bytes per pair (default: {DEFAULT_MAX_PAIRS}).')
 
 ##################### FUNCTIONS #########################
 
@@ -79,76 +128,228 @@ def read_cif(cif_path):
     return chain_coords, chain_plddt
 
 
+def pdockq_from_contacts(avg_if_plddt, n_if_contacts):
+    """Calculate pDockQ from the average interface plDDT and the number of interface contacts."""
+    x = avg_if_plddt * np.log10(n_if_contacts)
+    return 0.724 / (1 + np.exp(-0.052 * (x - 152.611))) + 0.018
+
+
+def ppv_from_pdockq(pdockq):
+    """Map pDockQ score(s) to PPV, i.e. the PPV of the lowest threshold still >= pDockQ.
+
+    Works on scalars and arrays alike using a single searchsorted call on the
+    (ascending) reversed threshold array.
+    """
+    pdockq = np.asarray(pdockq, dtype=float)
+    # Number of thresholds >= pdockq; the matching threshold is the last of these
+    n_above = len(PDOCKQ_THRESHOLDS) - np.searchsorted(PDOCKQ_THRESHOLDS[::-1], pdockq, side='left')
+    return PPV[np.maximum(n_above - 1, 0)]
+
+
 def calc_pdockq(chain_coords, chain_plddt, t):
     """Calculate the pDockQ scores."""
-    ch1, ch2 = [*chain_coords.keys()]
-    coords1, coords2 = chain_coords[ch1], chain_coords[ch2]
-    plddt1, plddt2 = chain_plddt[ch1], chain_plddt[ch2]
-
-    # Calculate pairwise distances
-    mat = np.append(coords1, coords2, axis=0)
-    a_min_b = mat[:, np.newaxis, :] - mat[np.newaxis, :, :]
-    dists = np.sqrt(np.sum(a_min_b.T ** 2, axis=0)).T
-    l1 = len(coords1)
-    contact_dists = dists[:l1, l1:]
-    contacts = np.argwhere(contact_dists <= t)
-
-    if contacts.shape[0] < 1:
-        pdockq = 0
-        ppv = 0
-    else:
-        avg_if_plddt = np.average(np.concatenate([
-            plddt1[np.unique(contacts[:, 0])],
-            plddt2[np.unique(contacts[:, 1])]
-        ]))
-        n_if_contacts = contacts.shape[0]
-        x = avg_if_plddt * np.log10(n_if_contacts)
-        pdockq = 0.724 / (1 + np.exp(-0.052 * (x - 152.611))) + 0.018
-
-        PPV = np.array([
-            0.98128027, 0.96322524, 0.95333044, 0.9400192,
-            0.93172991, 0.92420274, 0.91629946, 0.90952562, 0.90043139,
-            0.8919553, 0.88570037, 0.87822061, 0.87116417, 0.86040801,
-            0.85453785, 0.84294946, 0.83367787, 0.82238224, 0.81190228,
-            0.80223507, 0.78549007, 0.77766077, 0.75941223, 0.74006263,
-            0.73044282, 0.71391784, 0.70615739, 0.68635536, 0.66728511,
-            0.63555449, 0.55890174
-        ])
-        pdockq_thresholds = np.array([
-            0.67333079, 0.65666073, 0.63254566, 0.62604391,
-            0.60150931, 0.58313803, 0.5647381, 0.54122438, 0.52314392,
-            0.49659878, 0.4774676, 0.44661346, 0.42628389, 0.39990988,
-            0.38479715, 0.3649393, 0.34526004, 0.3262589, 0.31475668,
-            0.29750023, 0.26673725, 0.24561247, 0.21882689, 0.19651314,
-            0.17606258, 0.15398168, 0.13927677, 0.12024131, 0.09996019,
-            0.06968505, 0.02946438
-        ])
-        inds = np.argwhere(pdockq_thresholds >= pdockq)
-        if len(inds) > 0:
-            ppv = PPV[inds[-1]][0]
-        else:
-            ppv = PPV[0]
+    features = calc_interface_features_batch(*stack_models([(chain_coords, chain_plddt)]), t=t, cutoffs=[t])
+    return features['pdockq'][0], features['ppv'][0]
+
+
+def stack_models(models):
+    """Stack a list of (chain_coords, chain_plddt) models into padded arrays.
+
+    Every model must contain exactly two chains, as in calc_pdockq. Returns
+    float32 coordinates of shape (n_models, max_len, 3), plDDT of shape
+    (n_models, max_len) and boolean residue masks of shape (n_models, max_len)
+    for each of the two chains.
+    """
+    n = len(models)
+    chains = []
+    for chain_coords, _ in models:
+        ch1, ch2 = [*chain_coords.keys()]
+        chains.append((ch1, ch2))
+    l1 = max([len(models[i][0][ch[0]]) for i, ch in enumerate(chains)], default=0)
+    l2 = max([len(models[i][0][ch[1]]) for i, ch in enumerate(chains)], default=0)
+
+    coords1, coords2 = np.zeros((n, l1, 3), dtype=np.float32), np.zeros((n, l2, 3), dtype=np.float32)
+    plddt1, plddt2 = np.zeros((n, l1)), np.zeros((n, l2))
+    mask1, mask2 = np.zeros((n, l1), dtype=bool), np.zeros((n, l2), dtype=bool)
+    for i, ((chain_coords, chain_plddt), (ch1, ch2)) in enumerate(zip(models, chains)):
+        n1, n2 = len(chain_coords[ch1]), len(chain_coords[ch2])
+        coords1[i, :n1], plddt1[i, :n1], mask1[i, :n1] = chain_coords[ch1], chain_plddt[ch1], True
+        coords2[i, :n2], plddt2[i, :n2], mask2[i, :n2] = chain_coords[ch2], chain_plddt[ch2], True
+
+    return coords1, coords2, plddt1, plddt2, mask1, mask2
+
+
+def calc_interface_features_batch(coords1, coords2, plddt1, plddt2, mask1, mask2,
+                                  t=8, cutoffs=DEFAULT_CUTOFFS):
+    """Calculate interface features for a batch of stacked models (see stack_models).
+
+    The distance matrices of all models are computed at once, and contacts are
+    counted at every cutoff from the same matrices. Returns a dict of arrays with
+    one entry per model (first axis):
+        if_res1, if_res2   - boolean interface residue masks at t Å for each chain
+        n_contacts         - number of contacts at each cutoff, shape (n_models, len(cutoffs))
+        n_if_contacts      - number of contacts at t Å
+        n_if_res1/2        - number of interface residues in each chain at t Å
+        if_plddt_mean/std/min/median/q25/q75 - interface plDDT distribution at t Å
+        pdockq, ppv        - as calc_pdockq, 0 for models without contacts
+    """
+    pair_mask = mask1[:, :, np.newaxis] & mask2[:, np.newaxis, :]
+    # Accumulate float32 squared distances per axis in place, so that at most
+    # two (n_models, l1, l2) float arrays are alive at once
+    contact_dists = np.zeros(pair_mask.shape, dtype=np.float32)
+    diff = np.empty(pair_mask.shape, dtype=np.float32)
+    for k in range(3):
+        np.subtract(coords1[:, :, np.newaxis, k], coords2[:, np.newaxis, :, k], out=diff)
+        np.square(diff, out=diff)
+        contact_dists += diff
+    del diff
+    np.sqrt(contact_dists, out=contact_dists)
+    contact_dists[~pair_mask] = np.inf
 
-    return pdockq, ppv
+    n_contacts = np.stack([np.sum(contact_dists <= c, axis=(1, 2)) for c in cutoffs], axis=1)
+
+    contacts = contact_dists <= t
+    if_res1, if_res2 = contacts.any(axis=2), contacts.any(axis=1)
+    n_if_contacts = np.sum(contacts, axis=(1, 2))
+
+    # Interface plDDT over both chains, non-interface residues as nan
+    if_plddt = np.concatenate([np.where(if_res1, plddt1, np.nan),
+                               np.where(if_res2, plddt2, np.nan)], axis=1)
+    has_if = n_if_contacts > 0
+    if_plddt[~has_if] = 0  # avoid all-nan slices, masked out below
+
+    avg_if_plddt = np.nanmean(if_plddt, axis=1)
+    # Quantiles with the linear interpolation of np.percentile, indexed on the
+    # row-wise sorted values (nan sorts last) instead of looping over models
+    sorted_plddt = np.sort(if_plddt, axis=1)
+    n_if_plddt = np.sum(~np.isnan(if_plddt), axis=1)
+    rows = np.arange(len(if_plddt))
+    quantiles = []
+    for q in (0.25, 0.5, 0.75):
+        pos = q * (n_if_plddt - 1)
+        lo = np.floor(pos).astype(int)
+        hi = np.minimum(lo + 1, n_if_plddt - 1)
+        low_val, high_val = sorted_plddt[rows, lo], sorted_plddt[rows, hi]
+        quantiles.append(low_val + (pos - lo) * (high_val - low_val))
+    q25, median, q75 = quantiles
+    pdockq = np.where(has_if, pdockq_from_contacts(avg_if_plddt, np.maximum(n_if_contacts, 1)), 0)
+    ppv = np.where(has_if, ppv_from_pdockq(pdockq), 0)
+
+    def no_if_nan(values):
+        return np.where(has_if, values, np.nan)
+
+    return {
+        'if_res1': if_res1,
+        'if_res2': if_res2,
+        'n_contacts': n_contacts,
+        'n_if_contacts': n_if_contacts,
+        'n_if_res1': np.sum(if_res1, axis=1),
+        'n_if_res2': np.sum(if_res2, axis=1),
+        'if_plddt_mean': no_if_nan(avg_if_plddt),
+        'if_plddt_std': no_if_nan(np.nanstd(if_plddt, axis=1)),
+        'if_plddt_min': no_if_nan(sorted_plddt[:, 0]),
+        'if_plddt_q25': no_if_nan(q25),
+        'if_plddt_median': no_if_nan(median),
+        'if_plddt_q75': no_if_nan(q75),
+        'pdockq': pdockq,
+        'ppv': ppv,
+    }
+
+
+def score_cif_files(cif_paths, t=8, cutoffs=DEFAULT_CUTOFFS, batch_size=DEFAULT_BATCH_SIZE,
+                    max_pairs=DEFAULT_MAX_PAIRS):
+    """Compute interface features for many .cif files and return them as a DataFrame.
+
+    Files are read one by one and grouped into batches of at most batch_size
+    models and at most max_pairs padded residue pairs (n_models * l1 * l2), which
+    bounds the size of the stacked distance matrices. A single model larger than
+    max_pairs is scored on its own. Files that do not contain exactly two chains
+    are skipped. The interface residues of each chain are given as comma-separated
+    0-based indices into the chain's CB atoms. Rows are ranked by pDockQ, ties by file.
+    """
+    if batch_size < 1 or max_pairs < 1:
+        raise ValueError('batch_size and max_pairs must be >= 1')
+    cutoffs = sorted(set(cutoffs))
+
+    rows = []
+    names, models = [], []
+    l1 = l2 = 0
+
+    def score_batch():
+        features = calc_interface_features_batch(*stack_models(models), t=t, cutoffs=cutoffs)
+        batch_df = pd.DataFrame({'file': names})
+        for i, c in enumerate(cutoffs):
+            batch_df[f'n_contacts_{c:g}A'] = features['n_contacts'][:, i]
+        for key, values in features.items():
+            if values.ndim == 1:
+                batch_df[key] = values
+        for key in ['if_res1', 'if_res2']:
+            batch_df[key] = [','.join(map(str, np.flatnonzero(mask))) for mask in features[key]]
+        rows.append(batch_df)
+
+    for cif_path in cif_paths:
+        try:
+            chain_coords, chain_plddt = read_cif(cif_path)
+        except (ValueError, IndexError, OSError) as e:
+            print('Could not read file', cif_path, f'({e}), skipping', file=sys.stderr)
+            continue
+        if len(chain_coords.keys()) != 2:
+            print(len(chain_coords.keys()), 'chains in file', cif_path, '(expected 2), skipping', file=sys.stderr)
+            continue
+        n1, n2 = [len(coords) for coords in chain_coords.values()]
+        new_l1, new_l2 = max(l1, n1), max(l2, n2)
+        if models and (len(models) == batch_size or (len(models) + 1) * new_l1 * new_l2 > max_pairs):
+            score_batch()
+            names, models = [], []
+            new_l1, new_l2 = n1, n2
+        l1, l2 = new_l1, new_l2
+        names.append(cif_path)
+        models.append((chain_coords, chain_plddt))
+    if models:
+        score_batch()
+
+    if not rows:
+        return pd.DataFrame()
+    return pd.concat(rows, ignore_index=True).sort_values(['pdockq', 'file'], ascending=[False, True],
+                                                          kind='stable', ignore_index=True)
 
 
 ################# MAIN ####################
 
-# Parse args
-args = parser.parse_args()
+if __name__ == '__main__':
+    # Parse args
+    args = parser.parse_args()
+    t = 8  # Distance threshold in Å
 
-# Read chain coordinates and plDDT from CIF
-chain_coords, chain_plddt = read_cif(args.pdbfile[0])
+    batch_mode = args.tsv or args.outfile is not None
+    if not batch_mode:
+        if len(args.pdbfile) > 1:
+            parser.error('several --pdbfile arguments require batch mode (--tsv or --outfile)')
+        if args.cutoffs is not None or args.batch_size is not None or args.max_pairs is not None:
+            parser.error('--cutoffs, --batch_size and --max_pairs require batch mode (--tsv or --outfile)')
+
+    if batch_mode:
+        # Batch mode: rank all models by pDockQ together with their interface features
+        cutoffs = DEFAULT_CUTOFFS if args.cutoffs is None else args.cutoffs
+        batch_size = DEFAULT_BATCH_SIZE if args.batch_size is None else args.batch_size[0]
+        max_pairs = DEFAULT_MAX_PAIRS if args.max_pairs is None else args.max_pairs[0]
+        df = score_cif_files(args.pdbfile, t=t, cutoffs=cutoffs, batch_size=batch_size, max_pairs=max_pairs)
+        if args.outfile is not None:
+            df.to_csv(args.outfile[0], sep='\t', index=False)
+        else:
+            print(df.to_csv(sep='\t', index=False), end='')
+        sys.exit()
 
-# Check that there are at least two chains
-if len(chain_coords.keys()) < 2:
-    print('Only one chain in file', args.pdbfile[0])
-    sys.exit()
+    # Read chain coordinates and plDDT from CIF
+    chain_coords, chain_plddt = read_cif(args.pdbfile[0])
 
-# Calculate pDockQ
-t = 8  # Distance threshold in Å
-pdockq, ppv = calc_pdockq(chain_coords, chain_plddt, t)
+    # Check that there are at least two chains
+    if len(chain_coords.keys()) < 2:
+        print('Only one chain in file', args.pdbfile[0])
+        sys.exit()
 
-print('pDockQ =', np.round(pdockq, 3), 'for', args.pdbfile[0])
-print('This corresponds to a PPV of at least', ppv)
+    # Calculate pDockQ
+    pdockq, ppv = calc_pdockq(chain_coords, chain_plddt, t)
 
+    print('pDockQ =', np.round(pdockq, 3), 'for', args.pdbfile[0])
+    print('This corresponds to a PPV of at least', ppv)